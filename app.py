@@ -1,14 +1,17 @@
+import re
+import signal
+import sys
 from logging import Logger
 from pathlib import Path
 
-from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.events import FileSystemEvent, RegexMatchingEventHandler
 from watchdog.observers import Observer
 
 from scripts.base_compute_volatility import LOOKBACK_WINDOW
 from volatility_estimator.config import LOAD_DATA_PATH, RAW_FILE_NAME_PATTERN
-from volatility_estimator.estimator import VolatilityEstimatorName
+from volatility_estimator.estimator import VolatilityEstimatorName, get_estimator
 from volatility_estimator.logger import get_logger
-from volatility_estimator.process import incremental_compute_volatility, incremental_process_prices
+from volatility_estimator.process import incremental_estimate_volatility, incremental_process_prices
 
 STOCK_SPLITS: dict[str, dict[str, float]] = {"d": {"2017-05-22": 10}}
 ESTIMATOR_METHODS = [
@@ -16,24 +19,56 @@ ESTIMATOR_METHODS = [
     VolatilityEstimatorName.CLOSE_TO_CLOSE_STD_DEVIATION,
     VolatilityEstimatorName.YANG_ZHANG,
 ]
+# NOTE: built once and reused across events
+ESTIMATORS = {
+    estimator_method: get_estimator(estimator_method, lookback_window=LOOKBACK_WINDOW)
+    for estimator_method in ESTIMATOR_METHODS
+}
+SUPPORTS_CLOSED_EVENTS = sys.platform.startswith("linux")
 
 
-class Handler(FileSystemEventHandler):
+def _glob_to_file_name_regex(pattern: str) -> str:
+    # NOTE: unlike fnmatch.translate, wildcards never match path separators (so only the file name
+    # can match); character classes aren't supported
+    wildcards = {"*": r"[^/\\]*", "?": r"[^/\\]"}
+    return "".join(wildcards.get(char, re.escape(char)) for char in pattern) + r"\Z"
+
+
+# NOTE: glob translated to a regex once (watchdog compiles it once too) rather than re-matching the
+# glob per event; matches the file name at the end of the full event path
+RAW_FILE_NAME_REGEX = r"(?:.*[/\\])?" + _glob_to_file_name_regex(RAW_FILE_NAME_PATTERN)
+
+
+class Handler(RegexMatchingEventHandler):
     def __init__(self, logger: Logger):
+        super().__init__(
+            regexes=[RAW_FILE_NAME_REGEX], ignore_directories=True, case_sensitive=True
+        )
         self.logger = logger
 
-    def on_created(self, event: FileSystemEvent):
-        logger.info(f"Received created event - {event.src_path}")
+    def on_closed(self, event: FileSystemEvent):
+        # NOTE: inotify's IN_CLOSE_WRITE; fires once the writer has finished with the file
+        logger.info(f"Received closed event - {event.src_path}")
+        self._process_file(Path(event.src_path))
 
-        file_path = Path(event.src_path)
+    def on_moved(self, event: FileSystemEvent):
+        # NOTE: a file renamed/moved into place is complete on arrival (no close event follows);
+        # dispatched if either path matches, so only handle moves onto a matching name
+        if not any(regex.match(event.dest_path) for regex in self.regexes):
+            return
 
-        if not file_path.match(RAW_FILE_NAME_PATTERN):
-            logger.warning(
-                f"Found file {file_path.name} which does not match required pattern "
-                "({RAW_FILE_NAME_PATTERN}); leaving file in load directory..."
-            )
+        logger.info(f"Received moved event - {event.dest_path}")
+        self._process_file(Path(event.dest_path))
+
+    def on_created(self, event: FileSystemEvent):
+        # Only inotify (Linux) reports file closes; elsewhere fall back on creation
+        if SUPPORTS_CLOSED_EVENTS:
             return
 
+        logger.info(f"Received created event - {event.src_path}")
+        self._process_file(Path(event.src_path))
+
+    def _process_file(self, file_path: Path):
         _, stock, date = file_path.stem.split("_")
         formatted_date = f"{date[:4]}-{date[4:6]}-{date[6:]}"
 
@@ -46,12 +81,12 @@ class Handler(FileSystemEventHandler):
         file_path.unlink()
 
         logger.info(f"Computing historical volatility for {stock}...")
-        for estimator_method in ESTIMATOR_METHODS:
-            incremental_compute_volatility(
+        for estimator_method, estimator in ESTIMATORS.items():
+            incremental_estimate_volatility(
                 stock=stock,
                 date=formatted_date,
                 estimator_method=estimator_method,
-                lookback_window=LOOKBACK_WINDOW,
+                estimator=estimator,
             )
 
         logger.info("Finished handling event...")
@@ -61,16 +96,21 @@ if __name__ == "__main__":
     logger = get_logger()
 
     event_handler = Handler(logger)
-    observer = Observer()
+    # NOTE: full events so inotify reports files moved in from outside the watched directory as
+    # moves (to be handled on arrival) rather than creations
+    observer = Observer(generate_full_events=True) if SUPPORTS_CLOSED_EVENTS else Observer()
     observer.schedule(event_handler, LOAD_DATA_PATH)
     observer.start()
 
     logger.info(f"Observer started, watching {LOAD_DATA_PATH.absolute()}")
 
-    try:
-        while observer.is_alive():
-            observer.join(1)
-    finally:
+    # Block (without polling) until asked to stop, or until the observer thread dies (e.g. if
+    # handling an event raised)
+    def stop_observer(*_):
         observer.stop()
-        observer.join()
-        logger.warning("Observer stopped...")
+
+    signal.signal(signal.SIGINT, stop_observer)
+    signal.signal(signal.SIGTERM, stop_observer)
+
+    observer.join()
+    logger.warning("Observer stopped...")
@@ -2,7 +2,12 @@ import numpy as np
 import pandas as pd
 import pytest
 
-from volatility_estimator.cleaner import adjust_for_split
+from volatility_estimator.cleaner import (
+    _filter_non_trading_hours,
+    _remove_outliers,
+    adjust_for_split,
+)
+from volatility_estimator.config import END_TIME, START_TIME
 
 
 @pytest.fixture
@@ -31,3 +36,49 @@ def test_adjust_for_split_half(dummy_df: pd.DataFrame):
     )
 
     assert actual.equals(expected)
+
+
+def test_remove_outliers_drops_spike(dummy_df: pd.DataFrame):
+    frame = dummy_df.copy()
+    frame["price"] = 100 + 0.01 * np.sin(np.arange(len(frame)))
+    frame.loc[500, "price"] = 150
+
+    actual = _remove_outliers(frame)
+
+    assert 500 not in actual.index
+    assert len(actual) == len(frame) - 1
+
+
+def test_remove_outliers_drops_spikes_at_frame_start(dummy_df: pd.DataFrame):
+    # NOTE: the current tick is excluded from its own (truncated) window, even at the edges, so
+    # it can't inflate the MAD it is judged against
+    frame = dummy_df.copy()
+    frame["price"] = 100 + 0.01 * np.sin(np.arange(len(frame)))
+    frame.loc[:2, "price"] = 150
+
+    actual = _remove_outliers(frame)
+
+    assert actual.index[0] == 3
+    assert len(actual) == len(frame) - 3
+
+
+@pytest.mark.parametrize("num_rows", [2, 3])
+def test_remove_outliers_keeps_short_frame(dummy_df: pd.DataFrame, num_rows: int):
+    frame = dummy_df.head(num_rows).copy()
+    # Last price differs from its (identical) neighbours, so their MAD is zero
+    frame["price"] = 100.0
+    frame.loc[frame.index[-1], "price"] = 101.0
+
+    actual = _remove_outliers(frame)
+
+    assert actual.equals(frame)
+
+
+def test_filter_non_trading_hours(dummy_df: pd.DataFrame):
+    actual = _filter_non_trading_hours(dummy_df)
+
+    expected = dummy_df.loc[
+        (dummy_df["ts"].dt.time >= START_TIME) & (dummy_df["ts"].dt.time <= END_TIME)
+    ]
+
+    assert actual.equals(expected)
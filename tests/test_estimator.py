@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from volatility_estimator.config import NUM_TRADING_DAYS
+from volatility_estimator.estimator import (
+    VolatilityEstimatorName,
+    daily_aggregates,
+    get_estimator,
+)
+
+
+@pytest.fixture
+def alternating_df():
+    # Three ticks per day over five business days, alternating between two prices
+    days = pd.bdate_range("2024-07-22", periods=5)
+    timestamps = pd.DatetimeIndex(
+        [day + pd.Timedelta(hours=hour) for day in days for hour in (9, 12, 15)]
+    )
+    prices = np.where(np.arange(len(timestamps)) % 2 == 0, 100.0, 101.0)
+
+    return pd.DataFrame({"ts": timestamps, "price": prices, "date": timestamps.date})
+
+
+def test_tick_average_realised_variance(alternating_df: pd.DataFrame):
+    estimator = get_estimator(
+        VolatilityEstimatorName.TICK_AVERAGE_REALISED_VARIANCE, lookback_window=2
+    )
+
+    actual = estimator.estimate_volatility(alternating_df)
+
+    # Every log return has the same magnitude; first day is missing its first return
+    squared_log_return = np.log(101 / 100) ** 2
+    daily_variance = np.array([2, 3, 3, 3, 3]) * squared_log_return
+    expected = np.sqrt(
+        pd.Series(daily_variance).rolling(window=2).mean().to_numpy() * NUM_TRADING_DAYS
+    )
+
+    np.testing.assert_allclose(actual["rolling_historical_volatility"], expected)
+    assert (actual["date"] == pd.bdate_range("2024-07-22", periods=5)).all()
+
+
+@pytest.mark.parametrize("name", list(VolatilityEstimatorName))
+def test_update_matches_full_estimate(alternating_df: pd.DataFrame, name: VolatilityEstimatorName):
+    estimator = get_estimator(name, lookback_window=2)
+    last_date = alternating_df["date"].iloc[-1]
+    previous_days = alternating_df.loc[alternating_df["date"] < last_date]
+    new_day = alternating_df.loc[alternating_df["date"] == last_date]
+
+    state = daily_aggregates(previous_days).tail(estimator.state_length)
+    new_state, actual = estimator.update(new_day, state)
+
+    expected = estimator.estimate_volatility(alternating_df).tail(1)
+
+    assert len(new_state) == estimator.state_length
+    np.testing.assert_allclose(
+        actual["rolling_historical_volatility"], expected["rolling_historical_volatility"]
+    )
@@ -0,0 +1,164 @@
+import datetime
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pytest
+
+from volatility_estimator import process
+from volatility_estimator.estimator import VolatilityEstimatorName, get_estimator
+
+
+@pytest.fixture
+def holiday_df():
+    # Ticks over two weeks of business days, with no trading on a holiday (2024-07-04)
+    days = pd.bdate_range("2024-06-24", "2024-07-08").drop(pd.Timestamp("2024-07-04"))
+    timestamps = pd.DatetimeIndex(
+        [day + pd.Timedelta(hours=hour) for day in days for hour in (9, 12, 15)]
+    )
+    prices = 100 * np.exp(np.random.default_rng(0).normal(0, 0.01, len(timestamps)).cumsum())
+
+    return pd.DataFrame(
+        {
+            "ts": timestamps,
+            "price": prices.astype(np.float32),
+            "date": pd.Series(timestamps).astype(pd.ArrowDtype(pa.date32())),
+        }
+    )
+
+
+@pytest.fixture
+def data_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(process, "CLEAN_PRICE_PATH", tmp_path / "prices")
+    monkeypatch.setattr(process, "HIST_VOL_PATH", tmp_path / "historical_volatility")
+    return tmp_path
+
+
+def _write_prices(stock: str, frame: pd.DataFrame) -> None:
+    ds.write_dataset(
+        pa.Table.from_pandas(frame, preserve_index=False),
+        base_dir=process.CLEAN_PRICE_PATH / f"{stock}.parquet",
+        format="parquet",
+        partitioning=["date"],
+        partitioning_flavor="hive",
+        existing_data_behavior="delete_matching",
+    )
+
+
+@pytest.mark.parametrize("with_state", [True, False])
+def test_incremental_estimate_after_holiday(data_path, holiday_df: pd.DataFrame, with_state: bool):
+    name = VolatilityEstimatorName.TICK_AVERAGE_REALISED_VARIANCE
+    new_date = pd.Timestamp("2024-07-05")
+
+    _write_prices("a", holiday_df.loc[holiday_df["ts"] < new_date])
+    process.base_compute_volatility("a", name, lookback_window=3)
+    if not with_state:
+        process._state_path("a", name, 3).unlink()
+
+    _write_prices("a", holiday_df.loc[holiday_df["ts"].dt.normalize() == new_date])
+    process.incremental_compute_volatility("a", "2024-07-05", name, lookback_window=3)
+
+    output_path = process.HIST_VOL_PATH / "a" / f"{name}_3.parquet" / "2024-07-05.parquet"
+    actual = pd.read_parquet(output_path)
+
+    estimator = get_estimator(name, lookback_window=3)
+    expected = estimator.estimate_volatility(
+        holiday_df.loc[holiday_df["ts"] < new_date + pd.Timedelta(days=1)]
+    )
+
+    assert (actual["date"] == new_date).all()
+    np.testing.assert_allclose(
+        actual["rolling_historical_volatility"],
+        expected["rolling_historical_volatility"].tail(1),
+    )
+
+
+def test_incremental_estimate_of_earlier_date(data_path, holiday_df: pd.DataFrame):
+    name = VolatilityEstimatorName.TICK_AVERAGE_REALISED_VARIANCE
+
+    _write_prices("a", holiday_df)
+    process.base_compute_volatility("a", name, lookback_window=3)
+    state_path = process._state_path("a", name, 3)
+    state = pd.read_parquet(state_path)
+
+    process.incremental_compute_volatility("a", "2024-07-01", name, lookback_window=3)
+
+    output_path = process.HIST_VOL_PATH / "a" / f"{name}_3.parquet" / "2024-07-01.parquet"
+    actual = pd.read_parquet(output_path)
+
+    estimator = get_estimator(name, lookback_window=3)
+    expected = estimator.estimate_volatility(holiday_df).set_index("date")
+
+    np.testing.assert_allclose(
+        actual["rolling_historical_volatility"],
+        expected.loc[["2024-07-01"], "rolling_historical_volatility"],
+    )
+    assert pd.read_parquet(state_path).equals(state)
+
+
+def test_incremental_estimate_converts_single_file_output(data_path, holiday_df: pd.DataFrame):
+    name = VolatilityEstimatorName.TICK_AVERAGE_REALISED_VARIANCE
+    new_date = pd.Timestamp("2024-07-05")
+
+    _write_prices("a", holiday_df.loc[holiday_df["ts"] < new_date])
+    process.base_compute_volatility("a", name, lookback_window=3)
+
+    # Output as written before it was sharded
+    output_path = process.HIST_VOL_PATH / "a" / f"{name}_3.parquet"
+    hist_vol_frame = pd.read_parquet(output_path)
+    shutil.rmtree(output_path)
+    hist_vol_frame.to_parquet(output_path, index=False)
+
+    _write_prices("a", holiday_df.loc[holiday_df["ts"].dt.normalize() == new_date])
+    process.incremental_compute_volatility("a", "2024-07-05", name, lookback_window=3)
+
+    actual = pd.read_parquet(output_path)
+
+    assert actual["date"].tolist() == [*hist_vol_frame["date"], new_date]
+
+
+def test_load_price_frame_ignores_truncated_cache(tmp_path):
+    file_path = tmp_path / "prices_a_20240705.csv"
+    file_path.write_text("ts,price\n2024-07-05 09:00:00,100.0\n2024-07-05 09:00:01,100.5\n")
+
+    # Truncated (e.g. interrupted) write that is newer than the CSV
+    file_path.with_suffix(".parquet").write_bytes(b"PAR1")
+
+    actual = process._load_price_frame(file_path, use_cache=True)
+
+    assert actual["price"].tolist() == [100.0, 100.5]
+    assert process._load_price_frame(file_path, use_cache=True).equals(actual)
+
+
+def test_rebase_price_partitions(tmp_path):
+    stock_path = tmp_path / "a.parquet"
+    prices = pa.table(
+        {
+            "ts": pa.array(pd.date_range("2024-07-05 09:00", periods=300_000, freq="10ms")),
+            "price": pa.array(np.full(300_000, 100.0, dtype=np.float32)),
+        }
+    )
+    for date in ("2024-07-05", "2024-07-08"):
+        (stock_path / f"date={date}").mkdir(parents=True)
+        pq.write_table(
+            prices, stock_path / f"date={date}" / "part-0.parquet", row_group_size=65_536
+        )
+
+    process._rebase_price_partitions(stock_path, datetime.date(2024, 7, 8), split_ratio=4)
+
+    rebased = pq.ParquetFile(stock_path / "date=2024-07-05" / "part-0.parquet")
+    assert rebased.num_row_groups == 1
+    assert rebased.read().column("price").to_pylist() == [25.0] * 300_000
+
+    untouched = pq.read_table(stock_path / "date=2024-07-08" / "part-0.parquet")
+    assert untouched.column("price").to_pylist() == [100.0] * 300_000
+
+    assert sorted(path.name for path in stock_path.rglob("*")) == [
+        "date=2024-07-05",
+        "date=2024-07-08",
+        "part-0.parquet",
+        "part-0.parquet",
+    ]
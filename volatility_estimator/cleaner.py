@@ -1,8 +1,14 @@
+import datetime
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from numpy.lib.stride_tricks import sliding_window_view
 
 from volatility_estimator.config import END_TIME, START_TIME
 
+_NANOSECONDS_PER_DAY = 86_400 * 1_000_000_000
+
 
 def clean_price_frame(frame: pd.DataFrame, splits: dict[str, float]) -> pd.DataFrame:
     return (
@@ -16,28 +22,38 @@ def clean_price_frame(frame: pd.DataFrame, splits: dict[str, float]) -> pd.DataF
 
 
 def adjust_for_split(frame: pd.DataFrame, split: float) -> pd.DataFrame:
-    # NOTE: copy to avoid side-effecting
-    frame = frame.copy()
-    frame["price"] = frame["price"] / split
-
-    return frame
+    # NOTE: not used by the pipeline (see _adjust_for_all_splits); kept as a public helper
+    return _replace_prices(frame, frame["price"].to_numpy() / split)
 
 
 def _adjust_for_all_splits(frame: pd.DataFrame, splits: dict[str, float]) -> pd.DataFrame:
-    # NOTE: copy to avoid side-effecting
-    frame = frame.copy()
+    # NOTE: ts is sorted by this point, so pre-split prices are a contiguous prefix
+    timestamps = frame["ts"].to_numpy()
+    prices = frame["price"].to_numpy(copy=True)
 
     for split_date_str, split_ratio in splits.items():
-        split_date = pd.to_datetime(split_date_str, format="%Y-%m-%d")
-        frame.loc[frame["ts"] < split_date, "price"] /= split_ratio
+        split_date = pd.to_datetime(split_date_str, format="%Y-%m-%d").to_datetime64()
+        prices[: np.searchsorted(timestamps, split_date)] /= split_ratio
+
+    return _replace_prices(frame, prices)
+
+
+def _replace_prices(frame: pd.DataFrame, prices: np.ndarray) -> pd.DataFrame:
+    # NOTE: shallow copy shares the other columns; replacing price leaves the original untouched
+    frame = frame.copy(deep=False)
+    frame["price"] = prices
 
     return frame
 
 
 def _filter_non_trading_hours(frame: pd.DataFrame) -> pd.DataFrame:
     # P1 of Barndorff-Nielsen (2008)
-    return frame.loc[lambda row: row["ts"].dt.time >= START_TIME].loc[
-        lambda row: row["ts"].dt.time <= END_TIME
+    # NOTE: compare nanoseconds since midnight rather than boxing each `.dt.time` as an object
+    nanoseconds_of_day = frame["ts"].to_numpy().view("i8") % _NANOSECONDS_PER_DAY
+
+    return frame.loc[
+        (nanoseconds_of_day >= _time_to_nanoseconds(START_TIME))
+        & (nanoseconds_of_day <= _time_to_nanoseconds(END_TIME))
     ]
 
 
@@ -48,11 +64,15 @@ def _filter_zero_prices(frame: pd.DataFrame) -> pd.DataFrame:
 
 def _combine_identical_timestamps(frame: pd.DataFrame) -> pd.DataFrame:
     # T3 of Barndorff-Nielsen (2008)
+    # NOTE: duplicates are rare, so skip the groupby when already strictly increasing in time
+    if frame["ts"].is_monotonic_increasing and frame["ts"].is_unique:
+        return frame
+
     return frame.groupby("ts", as_index=False).median()
 
 
 def _remove_outliers(
-    frame: pd.DataFrame, window_size: int = 50, threshold: float = 10.0
+    frame: pd.DataFrame, window_size: int = 50, threshold: float = 10.0, min_neighbours: int = 10
 ) -> pd.DataFrame:
     # Q4 of Barndorff-Nielsen (2008)
     prices = frame["price"]
@@ -60,31 +80,18 @@ def _remove_outliers(
     if window_size % 2 != 0:
         raise ValueError("window_size must be even")
 
-    half_window = window_size // 2
-
-    # Define the median function excluding the middle value
-    def _median_exclude_middle(x):
-        without_middle = np.concatenate([x[:half_window], x[half_window + 1 :]])
-        return np.median(without_middle)
-
-    # Define the MAD function excluding the middle value
-    def _mad_exclude_middle(x):
-        without_middle = np.concatenate([x[:half_window], x[half_window + 1 :]])
-        median = np.median(without_middle)
-        return np.mean(np.abs(without_middle - median))
-
-    # Calculate the rolling centered median excluding the current observation
-    medians = prices.rolling(window=window_size, center=True, min_periods=1).apply(
-        _median_exclude_middle, raw=True
-    )
+    if prices.empty:
+        return frame
 
-    # Calculate the rolling MAD excluding the current observation
-    mads = prices.rolling(window=window_size, center=True, min_periods=1).apply(
-        _mad_exclude_middle, raw=True
+    # Calculate the rolling centered median and MAD excluding the current observation
+    # NOTE: rows with fewer than `min_neighbours` neighbours (e.g. in very short frames) are never
+    # flagged, since a median/MAD over so few prices is too noisy to judge an outlier by
+    medians, mads = _rolling_median_mad(
+        prices.to_numpy(dtype=np.float64), window_size, min_count=min_neighbours
     )
 
     # Calculate the deviation from the rolling median
-    deviations = np.abs(prices - medians)
+    deviations = np.abs(prices.to_numpy() - medians)
 
     # Identify the outliers
     outliers = deviations > (threshold * mads)
@@ -95,8 +102,54 @@ def _remove_outliers(
     return cleaned_frame
 
 
+def _rolling_median_mad(
+    values: np.ndarray, window_size: int, block_size: int = 8192, min_count: int = 1
+) -> tuple[np.ndarray, np.ndarray]:
+    # Centered windows are [i - half_window, i + half_window) to match pandas' `center=True`
+    # alignment; truncated edge windows are NaN-padded, and the current value is always the one
+    # excluded (so, near the edges, unlike dropping the window's middle element). Windows are
+    # processed in fixed-size blocks so scratch memory stays O(block_size * window_size) rather
+    # than O(N * window_size). Windows with fewer than `min_count` (non-padding) values give NaN.
+    if window_size % 2 != 0:
+        raise ValueError("window_size must be even")
+
+    half_window = window_size // 2
+    padded = np.pad(values, (half_window, half_window - 1), constant_values=np.nan)
+    windows = sliding_window_view(padded, window_size)
+
+    medians = np.empty(len(values))
+    mads = np.empty(len(values))
+
+    for start in range(0, len(values), block_size):
+        # NOTE: delete copies, so only this block is ever materialised
+        block = np.delete(windows[start : start + block_size], half_window, axis=1)
+
+        # Sorting pushes NaN padding to the end, so the median sits in the first `counts` entries
+        sorted_block = np.sort(block, axis=1)
+        counts = np.count_nonzero(~np.isnan(sorted_block), axis=1)
+        rows = np.arange(len(sorted_block))
+        lower = sorted_block[rows, np.maximum((counts - 1) // 2, 0)]
+        upper = sorted_block[rows, counts // 2]
+        block_medians = np.where(counts >= max(min_count, 1), 0.5 * (lower + upper), np.nan)
+
+        with np.errstate(invalid="ignore"):
+            block_mads = np.nansum(np.abs(block - block_medians[:, None]), axis=1) / counts
+
+        medians[start : start + block_size] = block_medians
+        mads[start : start + block_size] = block_mads
+
+    return medians, mads
+
+
+def _time_to_nanoseconds(time: datetime.time) -> int:
+    seconds = 3600 * time.hour + 60 * time.minute + time.second
+    return 1_000_000_000 * seconds + 1_000 * time.microsecond
+
+
 def _add_date_column(frame: pd.DataFrame) -> pd.DataFrame:
-    frame = frame.copy()
-    frame["date"] = frame["ts"].dt.date
+    # NOTE: shallow copy; only a new column is added, so ts and price needn't be duplicated
+    frame = frame.copy(deep=False)
+    # NOTE: arrow date32 (int32 days) rather than python `date` objects; partitions as YYYY-MM-DD
+    frame["date"] = frame["ts"].astype(pd.ArrowDtype(pa.date32()))
 
     return frame
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import StrEnum, auto
+from typing import Literal
 
 import numpy as np
 import pandas as pd
@@ -39,40 +40,92 @@ class VolatilityEstimatorName(StrEnum):
 @dataclass
 class VolatilityEstimator(ABC):
     lookback_window: int
+    # NOTE: passed through to pandas rolling aggregations; e.g. "numba" (if installed) to JIT them
+    engine: Literal["cython", "numba"] | None = None
+    engine_kwargs: dict[str, bool] | None = None
+
+    @property
+    def state_length(self) -> int:
+        # Number of trailing daily aggregates needed to produce the next estimate; one more than
+        # the lookback window since the first day's return needs the previous close
+        return self.lookback_window + 1
 
-    @abstractmethod
     def estimate_volatility(self, price_frame: pd.DataFrame) -> pd.DataFrame:
-        raise NotImplementedError
+        return self.estimate_volatility_from_daily(daily_aggregates(price_frame))
 
+    def update(
+        self, new_day_frame: pd.DataFrame, state: pd.DataFrame
+    ) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Append a new day to the trailing daily aggregates and estimate for that day only.
 
-@register_estimator(VolatilityEstimatorName.TICK_AVERAGE_REALISED_VARIANCE)
-class TickAverageRealisedVariance(VolatilityEstimator):
-    """Trade-to-Trade average realised variance historical volatility estimator."""
+        Returns the updated state and the (single row) volatility estimate.
+        """
+        new_daily = daily_aggregates(new_day_frame, previous_close=state["close"].iloc[-1])
+        state = pd.concat([state, new_daily]).tail(self.state_length)
 
-    def estimate_volatility(self, price_frame: pd.DataFrame) -> pd.DataFrame:
-        price_frame = price_frame.copy()
-        prices = price_frame["price"]
+        return state, self.estimate_volatility_from_daily(state).tail(1)
 
-        # Compute trade-to-trade log returns, even across days
-        price_frame["log_return"] = np.log(prices / prices.shift(1))
+    @abstractmethod
+    def estimate_volatility_from_daily(self, daily: pd.DataFrame) -> pd.DataFrame:
+        raise NotImplementedError
+
+
+def daily_aggregates(price_frame: pd.DataFrame, previous_close: float = np.nan) -> pd.DataFrame:
+    """Daily OHLC and realised variance (sum of squared trade-to-trade log returns), by date.
 
-        # Aggregate on each day and compute daily realised variance (sum of square LRs)
-        daily_realized_variance = price_frame.groupby("date", observed=True)["log_return"].apply(
-            lambda group_vector: np.sum(group_vector.dropna() ** 2)
+    Log returns span days, so the first return of the first day uses `previous_close` (if given).
+    """
+    # NOTE: prices are stored as float32; compute returns in double precision
+    prices = price_frame["price"].to_numpy(dtype=np.float64)
+
+    # Compute trade-to-trade log returns, even across days
+    # NOTE: one log pass then a difference of neighbours (no shifted copy or division)
+    log_prices = np.log(prices)
+    log_returns = np.empty_like(log_prices)
+    log_returns[:1] = log_prices[:1] - np.log(previous_close)
+    np.subtract(log_prices[1:], log_prices[:-1], out=log_returns[1:])
+
+    # NOTE: single grouping pass for all aggregates; sum skips a leading NaN log return
+    daily = (
+        pd.DataFrame(
+            {"price": prices, "squared_log_return": np.square(log_returns)},
+            index=price_frame.index,
+        )
+        .groupby(price_frame["date"], observed=True)
+        .agg(
+            open=("price", "first"),
+            high=("price", "max"),
+            low=("price", "min"),
+            close=("price", "last"),
+            realised_variance=("squared_log_return", "sum"),
         )
+    )
+    daily.index = pd.DatetimeIndex(_date_field_to_timestamp(daily.index), name="date")
 
-        # Compute (rolling) average
-        rolling_arv = daily_realized_variance.rolling(window=self.lookback_window).mean()
+    return daily
 
-        # Annualise
-        annualized_rolling_arv = rolling_arv * NUM_TRADING_DAYS
 
-        # Convert variance to volatility
-        annualized_rolling_ar_vol = annualized_rolling_arv.apply(np.sqrt)
+@register_estimator(VolatilityEstimatorName.TICK_AVERAGE_REALISED_VARIANCE)
+class TickAverageRealisedVariance(VolatilityEstimator):
+    """Trade-to-Trade average realised variance historical volatility estimator."""
+
+    def estimate_volatility_from_daily(self, daily: pd.DataFrame) -> pd.DataFrame:
+        # Compute (rolling) average of daily realised variance
+        rolling_arv = (
+            daily["realised_variance"]
+            .rolling(window=self.lookback_window)
+            .mean(engine=self.engine, engine_kwargs=self.engine_kwargs)
+        )
+
+        # Annualise and convert variance to volatility
+        # NOTE: work on the underlying array; result is built positionally alongside the dates, and
+        # the square root is taken in place on the annualised buffer
+        annualized_rolling_ar_vol = np.multiply(rolling_arv.to_numpy(), NUM_TRADING_DAYS)
+        np.sqrt(annualized_rolling_ar_vol, out=annualized_rolling_ar_vol)
 
         return pd.DataFrame(
             {
-                "date": _date_field_to_timestamp(annualized_rolling_arv.index),
+                "date": daily.index.to_numpy(),
                 "rolling_historical_volatility": annualized_rolling_ar_vol,
             }
         )
@@ -86,22 +139,25 @@ class CloseToCloseStdDeviation(VolatilityEstimator):
     - https://portfolioslab.com/tools/close-to-close-volatility
     """
 
-    def estimate_volatility(self, price_frame: pd.DataFrame) -> pd.DataFrame:
-        # Get last close price
-        last_prices = price_frame.groupby("date", observed=True)["price"].last()
-
+    def estimate_volatility_from_daily(self, daily: pd.DataFrame) -> pd.DataFrame:
         # Calculate close-to-close log returns
-        log_returns = (last_prices / last_prices.shift(1)).apply(np.log)
+        log_close = np.log(daily["close"].to_numpy())
+        log_returns = np.empty_like(log_close)
+        log_returns[:1] = np.nan
+        np.subtract(log_close[1:], log_close[:-1], out=log_returns[1:])
+        log_returns = pd.Series(log_returns)
 
         # Calculate 30-day rolling standard deviation of returns
-        rolling_volatility = log_returns.rolling(window=self.lookback_window).std()
+        rolling_volatility = log_returns.rolling(window=self.lookback_window).std(
+            engine=self.engine, engine_kwargs=self.engine_kwargs
+        )
 
         # Annualise
-        rolling_volatility_annualised = rolling_volatility * np.sqrt(NUM_TRADING_DAYS)
+        rolling_volatility_annualised = rolling_volatility.to_numpy() * np.sqrt(NUM_TRADING_DAYS)
 
         return pd.DataFrame(
             {
-                "date": _date_field_to_timestamp(last_prices.index),
+                "date": daily.index.to_numpy(),
                 "rolling_historical_volatility": rolling_volatility_annualised,
             }
         )
@@ -116,22 +172,47 @@ class YangZhang(VolatilityEstimator):
     - https://portfolioslab.com/tools/yang-zhang
     """
 
-    def estimate_volatility(self, price_frame: pd.DataFrame) -> pd.DataFrame:
-        ohlc = price_frame.set_index("ts")["price"].resample("B").ohlc()
-
-        rolling_variance = (NUM_TRADING_DAYS / self.lookback_window) * pd.DataFrame.rolling(
-            (ohlc.loc[:, "open"] / ohlc.loc[:, "close"].shift(1)).apply(np.log).fillna(0) ** 2
-            + 0.5 * (ohlc.loc[:, "high"] / ohlc.loc[:, "low"]).apply(np.log).fillna(0) ** 2
-            - (2 * np.log(2) - 1)
-            * (ohlc.loc[:, "close"] / ohlc.loc[:, "open"]).apply(np.log).fillna(0) ** 2,
-            window=self.lookback_window,
-        ).sum()
+    def estimate_volatility_from_daily(self, daily: pd.DataFrame) -> pd.DataFrame:
+        # NOTE: daily aggregates hold observed (traded) days only, so no empty-day padding
+        open_, high, low, close = daily[["open", "high", "low", "close"]].to_numpy().T
+
+        # NOTE: first day has no previous close; use its open so the overnight term is zero
+        previous_close = np.roll(close, 1)
+        previous_close[:1] = open_[:1]
+
+        # Daily variance terms, accumulated in place into two buffers rather than allocating a
+        # temporary per log, square and scale
+        daily_variance = np.divide(open_, previous_close)
+        np.log(daily_variance, out=daily_variance)
+        np.square(daily_variance, out=daily_variance)
+
+        term = np.divide(high, low)
+        np.log(term, out=term)
+        np.square(term, out=term)
+        term *= 0.5
+        daily_variance += term
+
+        np.divide(close, open_, out=term)
+        np.log(term, out=term)
+        np.square(term, out=term)
+        term *= 2 * np.log(2) - 1
+        daily_variance -= term
+
+        rolling_variance = (
+            pd.Series(daily_variance)
+            .rolling(window=self.lookback_window)
+            .sum(engine=self.engine, engine_kwargs=self.engine_kwargs)
+        )
 
-        rolling_volatility = rolling_variance.apply(np.sqrt)
+        # Annualise and convert variance to volatility, taking the square root in place
+        rolling_volatility = np.multiply(
+            rolling_variance.to_numpy(), NUM_TRADING_DAYS / self.lookback_window
+        )
+        np.sqrt(rolling_volatility, out=rolling_volatility)
 
         return pd.DataFrame(
             {
-                "date": rolling_volatility.index,
+                "date": daily.index.to_numpy(),
                 "rolling_historical_volatility": rolling_volatility,
             }
         )
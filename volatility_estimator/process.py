@@ -1,16 +1,53 @@
+import datetime
+import os
 import shutil
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import Any, Iterator
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
-from volatility_estimator.cleaner import adjust_for_split, clean_price_frame
+from volatility_estimator.cleaner import clean_price_frame
 from volatility_estimator.config import CLEAN_PRICE_PATH, HIST_VOL_PATH
-from volatility_estimator.estimator import VolatilityEstimatorName, get_estimator
+from volatility_estimator.estimator import (
+    VolatilityEstimator,
+    VolatilityEstimatorName,
+    daily_aggregates,
+    get_estimator,
+)
 from volatility_estimator.logger import get_logger
 
 logger = get_logger()
 
+# Tick data compresses ~2x better under zstd than snappy at similar write speed; large row groups
+# give downstream scans bigger vectorised batches. Sorted timestamps are near-constant increments,
+# so delta encoding stores them in a fraction of the plain (dictionary fallback) size; only prices
+# (repeated ticks) are dictionary encoded.
+# NOTE: options are shared by every price shard writer (dataset writes and split rebasing)
+PRICE_PARQUET_ROW_GROUP_SIZE = 1_000_000
+PRICE_PARQUET_OPTIONS: dict[str, Any] = {
+    "compression": "zstd",
+    "compression_level": 1,
+    "use_dictionary": ["price"],
+    "column_encoding": {"ts": "DELTA_BINARY_PACKED"},
+}
+
+# Clean prices are hive-partitioned by date, i.e. `<stock>.parquet/date=YYYY-MM-DD/*.parquet`
+PRICE_PARTITIONING = ds.partitioning(pa.schema([("date", pa.date32())]), flavor="hive")
+
+# NOTE: given up front when opening the dataset so no shard footers are read to infer it
+PRICE_SCHEMA = pa.schema(
+    [("ts", pa.timestamp("ns")), ("price", pa.float32()), ("date", pa.date32())]
+)
+
 
 def base_process_prices(
     stock: str,
@@ -20,23 +57,40 @@ def base_process_prices(
     logger.info(f"Processing files for stock {stock}")
 
     # Base processing and cleaning of stock files
-    stock_frame = _load_clean_comine_price_frames(stock_file_paths, stock_splits)
+    # NOTE: frames are streamed to the dataset as they are cleaned rather than combined first, so
+    # memory holds a few daily frames per worker rather than the full history
+    price_frames = _iter_clean_price_frames(stock_file_paths, stock_splits)
+
+    first_price_frame = next(price_frames, None)
+    if first_price_frame is None:
+        logger.warning(f"No prices found for stock {stock}")
+        return
+
+    price_table = pa.Table.from_pandas(first_price_frame, preserve_index=False)
+
+    def iter_price_batches() -> Iterator[pa.RecordBatch]:
+        yield from price_table.to_batches()
+        for price_frame in price_frames:
+            yield from pa.Table.from_pandas(
+                price_frame, schema=price_table.schema, preserve_index=False
+            ).to_batches()
 
     # Store as partitioned parquets
     output_path = CLEAN_PRICE_PATH / f"{stock}.parquet"
 
-    # Check doesn't exist already; delete if does
-    if output_path.exists():
-        logger.warning(f"Found existing data at {output_path}; deleting...")
-
-        # NOTE: might point to directory (since parquet sharded)
-        if output_path.is_file():
-            output_path.unlink()
-        else:
-            shutil.rmtree(output_path)
+    # NOTE: an unpartitioned (single file) dataset can't be partially replaced; delete it
+    if output_path.is_file():
+        logger.warning(f"Found existing unpartitioned data at {output_path}; deleting...")
+        output_path.unlink()
 
+    # NOTE: only partitions for dates being written are replaced; other dates are left untouched
     logger.info("Saving cleaned price data")
-    stock_frame.to_parquet(output_path, index=False, partition_cols=["date"])
+    _write_price_dataset(
+        iter_price_batches(),
+        schema=price_table.schema,
+        base_dir=output_path,
+        existing_data_behavior="delete_matching",
+    )
 
 
 def incremental_process_prices(stock: str, file_path: Path, split_ratio: float = 1) -> None:
@@ -50,8 +104,13 @@ def incremental_process_prices(stock: str, file_path: Path, split_ratio: float =
     cleaned_price_frame = clean_price_frame(price_frame, splits={})
 
     # Store as new parquet shard corresponding to the date
-    cleaned_price_frame.to_parquet(
-        f"{CLEAN_PRICE_PATH / stock}.parquet", index=False, partition_cols=["date"]
+    # NOTE: only the new date partition is written; file named after source so re-runs overwrite.
+    # New prices are already on the post-split basis, so this is their only write even on a split
+    _write_price_dataset(
+        pa.Table.from_pandas(cleaned_price_frame, preserve_index=False),
+        base_dir=f"{CLEAN_PRICE_PATH / stock}.parquet",
+        basename_template=f"{file_path.stem}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
     )
 
     # Need to reprocess old price data to align with future...
@@ -59,15 +118,17 @@ def incremental_process_prices(stock: str, file_path: Path, split_ratio: float =
         return
 
     logger.info("Stock has split; rebasing old prices...")
-    full_stock_frame = pd.read_parquet(f"{CLEAN_PRICE_PATH / stock}.parquet")
-    updated_stock_frame = adjust_for_split(full_stock_frame, split_ratio)
-
-    # Re-store full history
-    logger.info("Re-saving full stock price history...")
-    updated_stock_frame.to_parquet(
-        f"{CLEAN_PRICE_PATH / stock}.parquet", index=False, partition_cols=["date"]
+    _rebase_price_partitions(
+        CLEAN_PRICE_PATH / f"{stock}.parquet",
+        split_date=cleaned_price_frame["date"].min(),
+        split_ratio=split_ratio,
     )
 
+    # Stored estimator state holds pre-split prices; drop it so it is rebuilt from rebased history
+    for state_path in (HIST_VOL_PATH / stock).glob("*_state.parquet"):
+        logger.info(f"Removing stale estimator state at {state_path}")
+        state_path.unlink()
+
 
 def base_compute_volatility(
     stock: str,
@@ -89,16 +150,36 @@ def base_compute_volatility(
     logger.info(
         f"Computing historical volatility using {estimator_method=} with {lookback_window=}"
     )
-    hist_vol_frame = estimator.estimate_volatility(stock_frame)
+    daily_frame = daily_aggregates(stock_frame)
+    hist_vol_frame = estimator.estimate_volatility_from_daily(daily_frame)
 
     # Store volatility calculation
+    # NOTE: a directory of parquet files (one per write, named by first date) so that incremental
+    # updates can append a file rather than rewrite the history
     output_path = HIST_VOL_PATH / stock / f"{estimator_method}_{lookback_window}.parquet"
 
+    # Check doesn't exist already; delete if does
+    if output_path.exists():
+        logger.warning(f"Found existing data at {output_path}; deleting...")
+
+        # NOTE: might point to a file (if written before output was sharded)
+        if output_path.is_file():
+            output_path.unlink()
+        else:
+            shutil.rmtree(output_path)
+
     # Make directory if doesn't exist already
-    output_path.parent.mkdir(exist_ok=True)
+    output_path.mkdir(parents=True)
 
     logger.info(f"Storing result at {output_path}")
-    hist_vol_frame.to_parquet(output_path, index=False)
+    hist_vol_frame.to_parquet(
+        output_path / f"{hist_vol_frame['date'].min():%Y-%m-%d}.parquet", index=False
+    )
+
+    # Store trailing daily aggregates so incremental updates needn't reload price history
+    state_path = _state_path(stock, estimator_method, lookback_window)
+    logger.info(f"Storing estimator state at {state_path}")
+    daily_frame.tail(estimator.state_length).to_parquet(state_path)
 
 
 def incremental_compute_volatility(
@@ -115,78 +196,312 @@ def incremental_compute_volatility(
         **other_estimator_kwargs,
     )
 
-    # Get previous lookback trading days
-    # TODO: use better lookup
-    previous_days = pd.bdate_range(end=pd.to_datetime(date, format="%Y-%m-%d"), periods=lookback_window).date
-    logger.info(f"Only considering dates {previous_days}")
+    incremental_estimate_volatility(stock, date, estimator_method, estimator)
 
-    # NOTE: str(datetime.date) -> "YYYY-MM-DD"
-    parquet_file_paths_and_dates = [
-        (prev_date, CLEAN_PRICE_PATH / f"{stock}.parquet" / f"date={prev_date}")
-        for prev_date in previous_days
-    ]
 
-    logger.info(f"Loading relevant parquet shards at {CLEAN_PRICE_PATH / stock}")
-    subset_stock_frames: list[pd.DataFrame] = []
-    for prev_date, file_path in parquet_file_paths_and_dates:
-        if not file_path.exists():
-            logger.critical(f"Did not find data for {file_path.name}")
-            return
+def incremental_estimate_volatility(
+    stock: str,
+    date: str,
+    estimator_method: VolatilityEstimatorName,
+    estimator: VolatilityEstimator,
+) -> None:
+    # NOTE: as incremental_compute_volatility, but reusing an already-built estimator
+    lookback_window = estimator.lookback_window
 
-        date_price_frame = pd.read_parquet(file_path).assign(date=prev_date)
-        subset_stock_frames.append(date_price_frame)
+    # NOTE: trading days are the dates with stored prices (no business-day calendar), so holidays
+    # neither invalidate the state nor block a rebuild
+    partition_dates = _partition_dates(stock)
 
-    full_subset_stock_frame = pd.concat(subset_stock_frames, ignore_index=True)
+    state_path = _state_path(stock, estimator_method, lookback_window)
+    stored_state = pd.read_parquet(state_path) if state_path.exists() else None
+    state = _usable_state(stored_state, date, partition_dates, estimator.state_length - 1)
 
-    # Compute historical volatility
     logger.info(
         f"Computing historical volatility using {estimator_method=} with {lookback_window=}"
     )
 
-    hist_vol_frame = estimator.estimate_volatility(full_subset_stock_frame)
-    new_vol_estimate = hist_vol_frame.tail(1)
+    if state is not None:
+        # Only the new day's prices are needed on top of the stored daily aggregates
+        new_day_frame = _load_price_partitions(stock, np.array([date], dtype="datetime64[D]"))
+        if new_day_frame is None:
+            return
+
+        state, new_vol_estimate = estimator.update(new_day_frame, state)
+    else:
+        logger.warning(f"No up-to-date state at {state_path}; rebuilding from price history")
+        full_subset_stock_frame = _load_lookback_price_frame(
+            stock, date, estimator.state_length, partition_dates
+        )
+        if full_subset_stock_frame is None:
+            return
+
+        state = daily_aggregates(full_subset_stock_frame)
+        hist_vol_frame = estimator.estimate_volatility_from_daily(state)
+        new_vol_estimate = hist_vol_frame.tail(1)
+
+    # NOTE: re-running an earlier date (e.g. a backfill) mustn't discard the later days' state
+    if stored_state is not None and stored_state.index[-1] > pd.Timestamp(date):
+        logger.info(f"Keeping newer estimator state at {state_path}")
+    else:
+        logger.info(f"Storing estimator state at {state_path}")
+        state.tail(estimator.state_length).to_parquet(state_path)
 
-    # Load previous volatility frame
+    # Append new row as its own file; previous results are neither read nor rewritten
     output_path = HIST_VOL_PATH / stock / f"{estimator_method}_{lookback_window}.parquet"
 
-    logger.info("Loading previous volatility calc frame")
-    prev_vol = pd.read_parquet(output_path)
+    # NOTE: outputs written before they were sharded are a single file; move it into a directory
+    if output_path.is_file():
+        _shard_single_file_output(output_path, date)
+
+    logger.info(f"Adding new row to volatility calc at {output_path}")
+    new_vol_estimate.to_parquet(output_path / f"{date}.parquet", index=False)
+
+
+def _shard_single_file_output(output_path: Path, date: str) -> None:
+    logger.warning(f"Found unsharded volatility calc at {output_path}; converting to directory")
+
+    # Rows for this (or later) dates are dropped, as they are about to be re-estimated
+    hist_vol_frame = pd.read_parquet(output_path)
+    hist_vol_frame = hist_vol_frame.loc[hist_vol_frame["date"] < pd.Timestamp(date)]
+
+    # NOTE: built in a dot-prefixed temp directory and renamed over the file, so an interruption
+    # never loses the history
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    tmp_path.mkdir(exist_ok=True)
+    if not hist_vol_frame.empty:
+        hist_vol_frame.to_parquet(
+            tmp_path / f"{hist_vol_frame['date'].min():%Y-%m-%d}.parquet", index=False
+        )
+
+    output_path.unlink()
+    tmp_path.replace(output_path)
+
+
+def _state_path(
+    stock: str, estimator_method: VolatilityEstimatorName, lookback_window: int
+) -> Path:
+    return HIST_VOL_PATH / stock / f"{estimator_method}_{lookback_window}_state.parquet"
+
+
+def _usable_state(
+    state: pd.DataFrame | None, date: str, partition_dates: np.ndarray, min_length: int
+) -> pd.DataFrame | None:
+    if state is None:
+        return None
+
+    # Drop any rows for this (or later) dates, e.g. if the day is being reprocessed
+    state = state.loc[state.index < pd.Timestamp(date)]
+
+    # NOTE: too few days left (e.g. an earlier date being re-run) to estimate on top of
+    if state.empty or len(state) < min_length:
+        return None
+
+    # NOTE: state is only usable if it runs up to the previous trading day, i.e. no stored prices
+    # fall between its last date and date
+    skipped_dates = partition_dates[
+        (partition_dates > np.datetime64(state.index[-1], "D"))
+        & (partition_dates < np.datetime64(date, "D"))
+    ]
+    if skipped_dates.size:
+        return None
+
+    return state
+
+
+def _load_lookback_price_frame(
+    stock: str, date: str, num_days: int, partition_dates: np.ndarray
+) -> pd.DataFrame | None:
+    # Get trading days (dates with stored prices) up to and including date
+    previous_days = partition_dates[partition_dates <= np.datetime64(date, "D")][-num_days:]
+    if not previous_days.size or previous_days[-1] != np.datetime64(date, "D"):
+        logger.critical(f"Did not find data for date {date}")
+        return None
+
+    logger.info(f"Only considering dates {previous_days}")
+
+    return _load_price_partitions(stock, previous_days)
 
-    # Add new row
-    logger.info("Adding new row to volatility calc frame")
-    new_vol = pd.concat([prev_vol, new_vol_estimate], ignore_index=True)
 
-    # Re-save
-    logger.info(f"Re-storing result at {output_path}")
-    new_vol.to_parquet(output_path, index=False)
+def _partition_dates(stock: str) -> np.ndarray:
+    # NOTE: only the partition directory names are listed; no shards are opened
+    # NOTE: held as datetime64[D] rather than date objects; str() gives the partition's YYYY-MM-DD
+    partition_paths = (CLEAN_PRICE_PATH / f"{stock}.parquet").glob("date=*")
+    return np.sort(
+        np.array(
+            [partition_path.name.removeprefix("date=") for partition_path in partition_paths],
+            dtype="datetime64[D]",
+        )
+    )
 
 
-def _load_price_frame(file_path: Path) -> pd.DataFrame:
+def _load_price_partitions(stock: str, days: np.ndarray) -> pd.DataFrame | None:
+    # NOTE: list only the requested partitions (not the full history) and scan them in one go;
+    # date is restored from the partition key rather than assigned per row
+    stock_path = CLEAN_PRICE_PATH / f"{stock}.parquet"
+    logger.info(f"Loading relevant parquet shards at {stock_path}")
+    shard_paths = {day: sorted((stock_path / f"date={day}").glob("*.parquet")) for day in days}
+
+    missing_days = [str(day) for day, day_shard_paths in shard_paths.items() if not day_shard_paths]
+    if missing_days:
+        logger.critical(f"Did not find data for dates {missing_days}")
+        return None
+
+    dataset = ds.dataset(
+        [
+            str(shard_path)
+            for day_shard_paths in shard_paths.values()
+            for shard_path in day_shard_paths
+        ],
+        schema=PRICE_SCHEMA,
+        format="parquet",
+        partitioning=PRICE_PARTITIONING,
+        partition_base_dir=str(stock_path),
+    )
+    table = dataset.to_table().sort_by("ts")
+
+    return table.to_pandas(types_mapper={pa.date32(): pd.ArrowDtype(pa.date32())}.get)
+
+
+def _load_price_frame(file_path: Path, use_cache: bool = False) -> pd.DataFrame:
+    # NOTE: optionally keep a parquet copy beside the CSV so re-runs skip parsing; only for raw
+    # files that persist (e.g. batch), since load directory files are deleted once consumed
+    cache_path = file_path.with_suffix(".parquet")
+    if (
+        use_cache
+        and cache_path.exists()
+        and cache_path.stat().st_mtime >= file_path.stat().st_mtime
+    ):
+        logger.info(f"Loading cached file {cache_path.name}")
+        try:
+            return pq.read_table(cache_path).to_pandas(split_blocks=True, self_destruct=True)
+        except (OSError, pa.ArrowException):
+            logger.warning(f"Could not read cached file {cache_path.name}; re-parsing CSV")
+
     logger.info(f"Loading file {file_path.name}")
-    return pd.read_csv(
+    # NOTE: arrow's (multithreaded) reader parses ISO-8601 timestamps natively; prices are held as
+    # float32 (ample precision for ticks) to halve their footprint, estimators work in float64.
+    # Converting with split_blocks + self_destruct frees each arrow column as it is handed over
+    table = pa_csv.read_csv(
         file_path,
-        dtype={"price": "float64"},
-        parse_dates=["ts"],
+        convert_options=pa_csv.ConvertOptions(
+            column_types={"ts": pa.timestamp("ns"), "price": pa.float32()}
+        ),
+    )
+
+    if use_cache:
+        # NOTE: dot-prefixed temp file renamed over the cache, so an interrupted write never
+        # leaves a truncated (yet fresh-looking) cache behind
+        tmp_path = cache_path.with_name(f".{cache_path.name}.tmp")
+        pq.write_table(table, tmp_path)
+        tmp_path.replace(cache_path)
+
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def _write_price_dataset(
+    data: pa.Table | Iterator[pa.RecordBatch], base_dir: str | Path, **kwargs: Any
+) -> None:
+    ds.write_dataset(
+        data,
+        base_dir=base_dir,
+        format="parquet",
+        partitioning=["date"],
+        partitioning_flavor="hive",
+        file_options=ds.ParquetFileFormat().make_write_options(**PRICE_PARQUET_OPTIONS),
+        max_rows_per_group=PRICE_PARQUET_ROW_GROUP_SIZE,
+        **kwargs,
     )
 
 
-def _load_clean_comine_price_frames(
+def _rebase_price_partitions(
+    stock_path: Path, split_date: datetime.date, split_ratio: float
+) -> None:
+    # Rewrite each pre-split partition shard in place
+    shard_paths = [
+        shard_path
+        for partition_path in sorted(stock_path.glob("date=*"))
+        if datetime.date.fromisoformat(partition_path.name.removeprefix("date=")) < split_date
+        for shard_path in partition_path.glob("*.parquet")
+    ]
+
+    logger.info(f"Rebasing prices in {len(shard_paths)} shards before {split_date}")
+
+    # NOTE: shards are independent and arrow releases the GIL for IO/compute, so use threads
+    with ThreadPoolExecutor() as executor:
+        list(
+            executor.map(
+                partial(_rebase_price_shard, split_ratio=split_ratio),
+                shard_paths,
+            )
+        )
+
+
+def _rebase_price_shard(shard_path: Path, split_ratio: float) -> None:
+    # Stream record batches so peak memory is one batch rather than the whole shard
+    # NOTE: each batch is written as one row group, so batches are row-group sized (and may span
+    # the source's row groups) to keep the layout of other writes
+    parquet_file = pq.ParquetFile(shard_path)
+
+    # NOTE: dot-prefixed temp file is ignored by parquet readers until renamed over shard
+    tmp_path = shard_path.with_name(f".{shard_path.name}.tmp")
+    with pq.ParquetWriter(
+        tmp_path,
+        parquet_file.schema_arrow,
+        **PRICE_PARQUET_OPTIONS,
+    ) as writer:
+        for batch in parquet_file.iter_batches(batch_size=PRICE_PARQUET_ROW_GROUP_SIZE):
+            price_index = batch.schema.get_field_index("price")
+            writer.write_batch(
+                batch.set_column(
+                    price_index,
+                    batch.schema.field(price_index),
+                    pc.divide(
+                        batch.column(price_index),
+                        pa.scalar(split_ratio, type=batch.column(price_index).type),
+                    ),
+                ),
+                row_group_size=PRICE_PARQUET_ROW_GROUP_SIZE,
+            )
+
+    tmp_path.replace(shard_path)
+
+
+def _iter_clean_price_frames(
     stock_file_paths: Iterator[Path],
     stock_splits: dict[str, float],
-) -> pd.DataFrame:
-    price_frames: list[pd.DataFrame] = []
+) -> Iterator[pd.DataFrame]:
+    file_paths = list(stock_file_paths)
+
+    # NOTE: files are independent, so load and clean them across processes; no more workers than
+    # files, and only a couple of files per worker in flight (yielded in order) so finished frames
+    # don't pile up ahead of the consumer
+    max_workers = max(1, min(len(file_paths), os.cpu_count() or 1))
+    max_in_flight = 2 * max_workers
 
-    for file_path in stock_file_paths:
-        price_frame = _load_price_frame(file_path)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures: deque[Future[pd.DataFrame | None]] = deque()
+        for file_path in file_paths:
+            futures.append(executor.submit(_load_clean_price_frame, file_path, stock_splits))
+            if len(futures) < max_in_flight:
+                continue
 
-        if price_frame.empty:
-            logger.warning(f"File {file_path.name} has zero rows")
-            continue
+            if (price_frame := futures.popleft().result()) is not None:
+                yield price_frame
 
-        logger.info(f"Cleaning frame from {file_path.name}")
-        cleaned_price_frame = clean_price_frame(price_frame, splits=stock_splits)
+        while futures:
+            if (price_frame := futures.popleft().result()) is not None:
+                yield price_frame
 
-        price_frames.append(cleaned_price_frame)
 
-    logger.info("Combining daily price frames")
-    return pd.concat(price_frames, ignore_index=True)
+def _load_clean_price_frame(
+    file_path: Path,
+    stock_splits: dict[str, float],
+) -> pd.DataFrame | None:
+    price_frame = _load_price_frame(file_path, use_cache=True)
+
+    if price_frame.empty:
+        logger.warning(f"File {file_path.name} has zero rows")
+        return None
+
+    logger.info(f"Cleaning frame from {file_path.name}")
+    return clean_price_frame(price_frame, splits=stock_splits)